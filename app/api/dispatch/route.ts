@@ -0,0 +1,51 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { getLocationById } from '../../../lib/locationsCosmos';
+
+export async function GET(request: NextRequest) {
+  try {
+    const params = new URLSearchParams(request.nextUrl.searchParams);
+    const base = process.env.PATHFINDER_URL || 'http://localhost:5000';
+
+    // Resolve a registered stand to its coordinates
+    const locationId = params.get('locationId');
+    if (locationId) {
+      const location = await getLocationById(locationId);
+      if (!location || location.longitude === null || location.latitude === null) {
+        return NextResponse.json(
+          { error: `Location ${locationId} not found or has no coordinates` },
+          { status: 404 }
+        );
+      }
+      params.delete('locationId');
+      params.set('longitude', String(location.longitude));
+      params.set('latitude', String(location.latitude));
+    }
+
+    // Forward the request to the Python backend
+    const response = await fetch(`${base}/api/telemetry/dispatch?${params.toString()}`, {
+      method: 'GET',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+    });
+
+    if (!response.ok) {
+      const errorText = await response.text();
+      console.error('Python backend error:', response.status, errorText);
+      return NextResponse.json(
+        { error: `Backend error: ${response.status} ${response.statusText}` },
+        { status: response.status }
+      );
+    }
+
+    const data = await response.json();
+    return NextResponse.json(data);
+
+  } catch (error) {
+    console.error('Proxy error:', error);
+    return NextResponse.json(
+      { error: 'Failed to communicate with backend' },
+      { status: 500 }
+    );
+  }
+}
@@ -0,0 +1,46 @@
+import { NextRequest, NextResponse } from 'next/server';
+import { listLocations } from '../../../../lib/locationsCosmos';
+
+export async function POST(request: NextRequest) {
+  try {
+    const body = await request.json();
+    const airport = request.nextUrl.searchParams.get('airport');
+    const base = process.env.PATHFINDER_URL || 'http://localhost:5000';
+
+    // Check reachability of the registered locations unless the caller sends its own list
+    if (!Array.isArray(body.locations)) {
+      const locations = await listLocations(airport || undefined);
+      body.locations = locations
+        .filter((loc) => loc.isActive && loc.longitude !== null && loc.latitude !== null)
+        .map((loc) => ({ name: loc.name, coordinates: [loc.longitude, loc.latitude] }));
+    }
+
+    // Forward the request to the Python backend
+    const response = await fetch(`${base}/api/truckpath/isochrone${airport ? `?airport=${airport}` : ''}`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(body),
+    });
+
+    if (!response.ok) {
+      const errorText = await response.text();
+      console.error('Python backend error:', response.status, errorText);
+      return NextResponse.json(
+        { error: `Backend error: ${response.status} ${response.statusText}` },
+        { status: response.status }
+      );
+    }
+
+    const data = await response.json();
+    return NextResponse.json(data);
+
+  } catch (error) {
+    console.error('Proxy error:', error);
+    return NextResponse.json(
+      { error: 'Failed to communicate with backend' },
+      { status: 500 }
+    );
+  }
+}
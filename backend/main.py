@@ -35,7 +35,7 @@ if __name__ == "__main__":
     uvicorn.run(
         "main:app", host="0.0.0.0", port=5000, reload=True, log_level="info"
     )
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -45,10 +45,14 @@ from datetime import datetime, timedelta
 import json
 from pathlib import Path
 import asyncio
+import threading
 import time
 
 # Import the truckpath router
-from truckpath import router as truckpath_router
+from truckpath import router as truckpath_router, nearest_vehicles
+from telemetry_store import TELEMETRY_COLUMNS, parse_ingest_body, store as telemetry_store
+from telemetry_index import TelemetryIndex, to_ns
+import telemetry_analytics
 
 # Create FastAPI app
 app = FastAPI(
@@ -89,9 +93,18 @@ is_streaming: bool = False
 stream_task: Optional[asyncio.Task] = None
 current_row_index: int = 0
 
+CSV_PATH = Path(__file__).parent.parent / "telemetry_expanded.csv"
+
+# Cached query index, rebuilt when the CSV or the ingested data changes
+INDEX_REFRESH_SECONDS = 5
+telemetry_index: Optional[TelemetryIndex] = None
+telemetry_index_key: Optional[tuple] = None
+telemetry_index_built_at: float = 0.0
+telemetry_index_lock = threading.Lock()
+
 def load_telemetry_data() -> pd.DataFrame:
-    """Load and preprocess telemetry data from CSV"""
-    csv_path = Path(__file__).parent.parent / "telemetry_expanded.csv"
+    """Load and preprocess telemetry data from CSV plus points received by the ingest API"""
+    csv_path = CSV_PATH
     
     if not csv_path.exists():
         raise FileNotFoundError(f"CSV file not found at {csv_path}")
@@ -101,15 +114,17 @@ def load_telemetry_data() -> pd.DataFrame:
     # Load CSV with enhanced columns including the new fields
     df = pd.read_csv(
         csv_path,
-        usecols=[
-            "dateProcessed", "longitude", "latitude", "speed", 
-            "heading", "engineState", "plateNumber", "locationName",
-            "Position de la Cabine", "territoriesName", "enterTerritories", "exitTerritories"
-        ]
+        usecols=TELEMETRY_COLUMNS
     )
     
     print(f"✅ Loaded {len(df)} rows from CSV")
     
+    # Append points pushed through /api/telemetry/ingest (recent windows kept in memory)
+    ingested_df = telemetry_store.frame()
+    if not ingested_df.empty:
+        df = pd.concat([df, ingested_df[TELEMETRY_COLUMNS]], ignore_index=True)
+        print(f"📥 Added {len(ingested_df)} ingested rows")
+    
     # Convert dateProcessed to datetime
     df['dateProcessed'] = pd.to_datetime(df['dateProcessed'], errors='coerce')
     
@@ -117,8 +132,8 @@ def load_telemetry_data() -> pd.DataFrame:
     df = df.dropna(subset=['dateProcessed', 'longitude', 'latitude', 'plateNumber'])
     df = df[(df['longitude'] != 0) & (df['latitude'] != 0)]
     
-    # Sort by timestamp (oldest first for sequential streaming)
-    df = df.sort_values(by='dateProcessed', ascending=True)
+    # Sort by timestamp (oldest first for sequential streaming); stable so CSV order is kept on ties
+    df = df.sort_values(by='dateProcessed', ascending=True, kind='stable')
     
     print(f"🧹 Cleaned data: {len(df)} valid rows")
     print(f"📅 Date range: {df['dateProcessed'].min()} to {df['dateProcessed'].max()}")
@@ -129,11 +144,73 @@ def load_telemetry_data() -> pd.DataFrame:
     
     return df
 
+def get_telemetry_index() -> TelemetryIndex:
+    """Return the query index, rebuilding it at most every INDEX_REFRESH_SECONDS while data changes.
+
+    Blocking: call it through asyncio.to_thread. While one thread rebuilds,
+    the others keep serving the previous index instead of waiting.
+    """
+    global telemetry_index, telemetry_index_key, telemetry_index_built_at
+    
+    key = (CSV_PATH.stat().st_mtime, telemetry_store.version)
+    if telemetry_index is not None:
+        stale = key != telemetry_index_key
+        if not stale or time.time() - telemetry_index_built_at < INDEX_REFRESH_SECONDS:
+            return telemetry_index
+        if not telemetry_index_lock.acquire(blocking=False):
+            return telemetry_index
+    else:
+        telemetry_index_lock.acquire()
+    try:
+        # Another thread may have built it while this one waited for the lock
+        if telemetry_index is None or telemetry_index_key != key:
+            telemetry_index = TelemetryIndex(load_telemetry_data())
+            telemetry_index_key = key
+            telemetry_index_built_at = time.time()
+            print(f"🗂️ Telemetry index built over {len(telemetry_index)} rows")
+    finally:
+        telemetry_index_lock.release()
+    
+    return telemetry_index
+
+def parse_telemetry_filters(plates: Optional[str], start: Optional[str], end: Optional[str]):
+    """Parse the shared plates/start/end query parameters; raises ValueError on bad input"""
+    plate_list = [p.strip() for p in plates.split(",") if p.strip()] if plates else None
+    start_ns = to_ns(start) if start else None
+    end_ns = to_ns(end) if end else None
+    return plate_list, start_ns, end_ns
+
+def parse_bbox(bbox: str):
+    """Parse "minLon,minLat,maxLon,maxLat"; raises ValueError unless it is a valid WGS84 box"""
+    min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(","))
+    # Chained comparisons are False for NaN, so this also rejects nan/inf
+    if not (-180 <= min_lon <= max_lon <= 180 and -90 <= min_lat <= max_lat <= 90):
+        raise ValueError("bbox must be finite minLon,minLat,maxLon,maxLat within -180..180 / -90..90 with min <= max")
+    return min_lon, min_lat, max_lon, max_lat
+
+def ingest_truncated_before() -> Optional[str]:
+    """Time before which ingested points were dropped from memory (only in the spill files), if any"""
+    truncated = telemetry_store.truncated_before
+    return truncated.isoformat() if truncated is not None else None
+
+async def get_analytics_inputs(plates: Optional[str], start: Optional[str], end: Optional[str]):
+    """Validate analytics filters and return them with the current telemetry index"""
+    try:
+        filters = parse_telemetry_filters(plates, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query parameters: {str(e)}")
+    
+    try:
+        return (await asyncio.to_thread(get_telemetry_index), *filters)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load telemetry: {str(e)}")
+
 @app.on_event("startup")
 async def startup_event():
     """Load data when the application starts"""
     print("🚀 Starting Fleet Telemetry API...")
     try:
+        telemetry_store.load_spilled()
         load_telemetry_data()
         print("🎯 API ready! Data will be streamed sequentially from CSV")
         print(f"📍 Starting position: Row {current_row_index + 1}")
@@ -141,6 +218,12 @@ async def startup_event():
         print(f"❌ Error loading data: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Spill any buffered ingest windows before exiting"""
+    telemetry_store.seal_all()
+    await asyncio.to_thread(telemetry_store.spill_pending)
+
 @app.get("/")
 async def root():
     """Root endpoint with API information"""
@@ -359,6 +442,195 @@ async def reset_stream():
         "status": "reset"
     }
 
+@app.post("/api/telemetry/ingest")
+async def ingest_telemetry(request: Request, background_tasks: BackgroundTasks):
+    """Ingest a batch of GPS points (NDJSON or JSON array) into the telemetry ring buffer"""
+    body = await request.body()
+    
+    try:
+        batch, rejected = parse_ingest_body(body)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid telemetry batch: {str(e)}")
+    
+    sealed = telemetry_store.append(batch)
+    if sealed:
+        # Write sealed windows to disk after the response is sent
+        background_tasks.add_task(telemetry_store.spill_pending)
+    
+    return {
+        "accepted": len(batch["dateProcessed"]),
+        "rejected": rejected,
+        "sealedWindows": sealed,
+        "buffer": telemetry_store.stats()
+    }
+
+@app.get("/api/telemetry/query")
+async def query_telemetry(
+    plates: Optional[str] = Query(None, description="Comma-separated plate numbers"),
+    start: Optional[str] = Query(None, description="ISO start time (inclusive)"),
+    end: Optional[str] = Query(None, description="ISO end time (inclusive)"),
+    bbox: Optional[str] = Query(None, description="minLon,minLat,maxLon,maxLat"),
+    territory: Optional[str] = Query(None, description="Territory to match, also inside multi-territory values like K01|K05"),
+    cursor: Optional[str] = Query(None, description="nextCursor from the previous page"),
+    limit: int = Query(1000, ge=1, le=10000),
+):
+    """Query historical telemetry by plate, time range and area, streamed as NDJSON in time order.
+
+    Ingested points older than the in-memory retention are only in the spill
+    files; X-Truncated-Before gives that cutoff when some were dropped.
+    """
+    try:
+        plate_list, start_ns, end_ns = parse_telemetry_filters(plates, start, end)
+        box = parse_bbox(bbox) if bbox else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid query parameters: {str(e)}")
+    
+    try:
+        index = await asyncio.to_thread(get_telemetry_index)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load telemetry: {str(e)}")
+    
+    try:
+        rows, next_cursor = index.query(
+            plates=plate_list, start_ns=start_ns, end_ns=end_ns,
+            bbox=box, territory=territory, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid cursor: {str(e)}")
+    
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Result-Count": str(len(rows)),
+        "Access-Control-Expose-Headers": "X-Next-Cursor, X-Result-Count, X-Truncated-Before"
+    }
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    truncated_before = ingest_truncated_before()
+    if truncated_before:
+        headers["X-Truncated-Before"] = truncated_before
+    
+    return StreamingResponse(
+        index.iter_ndjson(rows),
+        media_type="application/x-ndjson",
+        headers=headers
+    )
+
+@app.get("/api/telemetry/analytics/heatmap")
+async def telemetry_heatmap(
+    plates: Optional[str] = Query(None, description="Comma-separated plate numbers"),
+    start: Optional[str] = Query(None, description="ISO start time (inclusive)"),
+    end: Optional[str] = Query(None, description="ISO end time (inclusive)"),
+    resolution: float = Query(100, gt=0, le=10000, description="Cell size in meters"),
+    shape: str = Query("square", pattern="^(square|hex)$"),
+):
+    """Presence (points and dwell seconds) and speed aggregated on a square or hex grid.
+
+    Like every analytics endpoint, it only covers ingested points retained in
+    memory; truncatedBefore gives the cutoff when older ones were dropped.
+    """
+    index, plate_list, start_ns, end_ns = await get_analytics_inputs(plates, start, end)
+    result = telemetry_analytics.heatmap(index, plate_list, start_ns, end_ns, resolution, shape)
+    return {**result, "truncatedBefore": ingest_truncated_before()}
+
+@app.get("/api/telemetry/analytics/dwell")
+async def telemetry_dwell(
+    plates: Optional[str] = Query(None, description="Comma-separated plate numbers"),
+    start: Optional[str] = Query(None, description="ISO start time (inclusive)"),
+    end: Optional[str] = Query(None, description="ISO end time (inclusive)"),
+    by: str = Query("location", pattern="^(location|cabine)$"),
+):
+    """Dwell time per locationName (by=location) or Position de la Cabine (by=cabine)"""
+    index, plate_list, start_ns, end_ns = await get_analytics_inputs(plates, start, end)
+    result = telemetry_analytics.dwell_time(index, plate_list, start_ns, end_ns, by)
+    return {**result, "truncatedBefore": ingest_truncated_before()}
+
+@app.get("/api/telemetry/analytics/idle")
+async def telemetry_idle(
+    plates: Optional[str] = Query(None, description="Comma-separated plate numbers"),
+    start: Optional[str] = Query(None, description="ISO start time (inclusive)"),
+    end: Optional[str] = Query(None, description="ISO end time (inclusive)"),
+):
+    """Idle-engine time per plate, with the time spent in each engineState"""
+    index, plate_list, start_ns, end_ns = await get_analytics_inputs(plates, start, end)
+    result = telemetry_analytics.engine_time(index, plate_list, start_ns, end_ns)
+    return {**result, "truncatedBefore": ingest_truncated_before()}
+
+@app.get("/api/telemetry/dispatch")
+async def dispatch_nearest_trucks(
+    longitude: float = Query(..., ge=-180, le=180, description="Target stand longitude"),
+    latitude: float = Query(..., ge=-90, le=90, description="Target stand latitude"),
+    k: int = Query(5, ge=1, le=50, description="Number of trucks to return"),
+    availability: Optional[str] = Query("Available", description="Comma-separated availability states to keep (empty for any)"),
+    engine: Optional[str] = Query(None, description="Comma-separated engineState values to keep"),
+    max_minutes: Optional[float] = Query(None, gt=0, description="Ignore trucks with a longer ETA than this"),
+    max_age_minutes: float = Query(30, gt=0, description="Ignore trucks whose latest fix is older than this"),
+):
+    """The k trucks with the lowest ETA (road time plus snap leg) to a stand, from their latest positions.
+
+    Fix ages are measured from the newest fix received from any truck, so a
+    replayed CSV behaves like a live feed.
+    """
+    try:
+        index = await asyncio.to_thread(get_telemetry_index)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to load telemetry: {str(e)}")
+    
+    # Latest row of each plate is the last entry of its time-sorted row index
+    latest_rows = [rows[-1] for rows in index.plate_rows.values()]
+    latest = index.df.iloc[latest_rows]
+    
+    if availability:
+        states = [s.strip() for s in availability.split(",") if s.strip()]
+        latest = latest[latest['VehicleAvailabilityEvent_AvailabilityStateType'].isin(states)]
+    if engine:
+        states = [s.strip() for s in engine.split(",") if s.strip()]
+        latest = latest[latest['engineState'].isin(states)]
+    
+    # The index is time-sorted, so its last row is the newest fix of any truck
+    newest = index.df['dateProcessed'].iloc[-1] if len(index) else pd.Timestamp.now()
+    fresh = latest['dateProcessed'] >= newest - timedelta(minutes=max_age_minutes)
+    stale_count = int((~fresh).sum())
+    latest = latest[fresh]
+    
+    vehicles = list(zip(latest['longitude'].tolist(), latest['latitude'].tolist()))
+    
+    try:
+        target_node, ranked, unreachable = await asyncio.to_thread(
+            nearest_vehicles, (longitude, latitude), vehicles, k,
+            max_seconds=max_minutes * 60 if max_minutes else None
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to rank trucks: {str(e)}")
+    
+    candidates = []
+    for i, road_seconds, snap_meters, eta_seconds in ranked:
+        row = latest.iloc[i]
+        candidates.append({
+            "plateNumber": str(row['plateNumber']),
+            "timestamp": row['dateProcessed'].isoformat(),
+            "ageMinutes": round((newest - row['dateProcessed']).total_seconds() / 60, 2),
+            "longitude": float(row['longitude']),
+            "latitude": float(row['latitude']),
+            "engineState": str(row['engineState']) if pd.notna(row['engineState']) else None,
+            "availabilityState": str(row['VehicleAvailabilityEvent_AvailabilityStateType']) if pd.notna(row['VehicleAvailabilityEvent_AvailabilityStateType']) else None,
+            "locationName": str(row['locationName']) if pd.notna(row['locationName']) else None,
+            "roadTimeMinutes": round(road_seconds / 60, 2),
+            "snapDistanceMeters": round(snap_meters, 1),
+            "etaMinutes": round(eta_seconds / 60, 2)
+        })
+    
+    return {
+        "target": {"longitude": longitude, "latitude": latitude, "node": target_node},
+        "total": len(candidates),
+        "candidates": candidates,
+        "consideredVehicles": len(vehicles),
+        "staleVehicles": stale_count,
+        "unreachableVehicles": len(unreachable),
+        "message": f"{len(candidates)} of {len(vehicles)} matching trucks ranked by ETA ({len(unreachable)} unreachable, {stale_count} stale)"
+    }
+
 @app.get("/api/telemetry/coordinates")
 async def get_current_coordinates():
     """Get current coordinates for all vehicles (latest data point for each)"""
@@ -385,7 +657,8 @@ async def get_current_coordinates():
                 "cabinePosition": str(row['Position de la Cabine']) if pd.notna(row['Position de la Cabine']) else None,
                 "territoriesName": str(row['territoriesName']) if pd.notna(row['territoriesName']) else None,
                 "enterTerritories": str(row['enterTerritories']) if pd.notna(row['enterTerritories']) else None,
-                "exitTerritories": str(row['exitTerritories']) if pd.notna(row['exitTerritories']) else None
+                "exitTerritories": str(row['exitTerritories']) if pd.notna(row['exitTerritories']) else None,
+                "availabilityState": str(row['VehicleAvailabilityEvent_AvailabilityStateType']) if pd.notna(row['VehicleAvailabilityEvent_AvailabilityStateType']) else None
             })
         
         return {
@@ -414,6 +687,7 @@ async def health_check():
             "uniqueTerritories": df['territoriesName'].nunique() if not df.empty else 0,
             "currentRowIndex": current_row_index,
             "streaming": is_streaming,
+            "ingest": telemetry_store.stats(),
             "dataRange": {
                 "min": df['dateProcessed'].min().isoformat() if not df.empty else None,
                 "max": df['dateProcessed'].max().isoformat() if not df.empty else None
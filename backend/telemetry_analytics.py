@@ -0,0 +1,236 @@
+import math
+from typing import Callable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from telemetry_index import TelemetryIndex
+
+# Time between two samples of a vehicle above this is treated as missing data, not dwell
+MAX_SAMPLE_GAP_SECONDS = 600
+METERS_PER_DEGREE = 111_320
+AGGREGATE_CACHE_SIZE = 32
+
+IDLE_ENGINE_STATE = "Idle"
+DWELL_COLUMNS = {
+    "location": "locationName",
+    "cabine": "Position de la Cabine",
+}
+
+
+def cached(index: TelemetryIndex, key: tuple, compute: Callable[[], dict]) -> dict:
+    """Memoize an aggregate on the index (LRU, AGGREGATE_CACHE_SIZE entries)"""
+    cache = index.aggregate_cache
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    result = compute()
+    cache[key] = result
+    if len(cache) > AGGREGATE_CACHE_SIZE:
+        cache.popitem(last=False)
+    return result
+
+
+def sample_durations(index: TelemetryIndex, rows: np.ndarray) -> np.ndarray:
+    """Seconds each sample lasts: the gap to the same vehicle's next sample in `rows`"""
+    durations = np.zeros(len(rows), dtype=np.float64)
+    if len(rows) < 2:
+        return durations
+
+    # Stable sort keeps time order inside each plate
+    codes = index.plate_codes[rows]
+    order = np.argsort(codes, kind="stable")
+    gaps = np.diff(index.ts[rows][order]) / 1e9
+    same_plate = codes[order][1:] == codes[order][:-1]
+    durations[order[:-1]] = np.where(same_plate & (gaps <= MAX_SAMPLE_GAP_SECONDS), gaps, 0.0)
+    return durations
+
+
+def _group_max(values: np.ndarray, groups: np.ndarray, size: int) -> np.ndarray:
+    """Per-group max of non-NaN values (NaN for groups without any)"""
+    result = np.full(size, np.nan)
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return result
+    order = np.argsort(groups[valid], kind="stable")
+    sorted_groups = groups[valid][order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    result[sorted_groups[starts]] = np.maximum.reduceat(values[valid][order], starts)
+    return result
+
+
+def _round_or_none(values: np.ndarray, digits: int = 2) -> List[Optional[float]]:
+    return [None if np.isnan(v) else round(float(v), digits) for v in values]
+
+
+def heatmap(
+    index: TelemetryIndex,
+    plates: Optional[List[str]],
+    start_ns: Optional[int],
+    end_ns: Optional[int],
+    resolution_m: float,
+    shape: str = "square",
+) -> dict:
+    """Presence and speed per square or hexagonal cell of `resolution_m` meters"""
+    key = ("heatmap", tuple(plates) if plates else None, start_ns, end_ns, resolution_m, shape)
+    return cached(index, key, lambda: _heatmap(index, plates, start_ns, end_ns, resolution_m, shape))
+
+
+def _heatmap(index, plates, start_ns, end_ns, resolution_m, shape) -> dict:
+    rows = index.select_rows(plates, start_ns, end_ns)
+
+    # Local equirectangular projection; the reference latitude only depends on the data,
+    # so cells line up between requests
+    ref_lat = round(float(np.median(index.lat)), 1) if len(index) else 0.0
+    x_scale = METERS_PER_DEGREE * math.cos(math.radians(ref_lat))
+    x = index.lon[rows] * x_scale
+    y = index.lat[rows] * METERS_PER_DEGREE
+
+    if shape == "hex":
+        # Pointy-top axial coordinates with cube rounding; resolution is the flat-to-flat width
+        size = resolution_m / math.sqrt(3)
+        q = (math.sqrt(3) / 3 * x - y / 3) / size
+        r = (2 / 3 * y) / size
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+        cells = np.stack([rq, rr], axis=1).astype(np.int64)
+    else:
+        cells = np.floor(np.stack([x, y], axis=1) / resolution_m).astype(np.int64)
+
+    durations = sample_durations(index, rows)
+    speed = index.df["speed"].to_numpy(dtype=np.float64)[rows]
+
+    unique_cells, groups = np.unique(cells, axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    n = len(unique_cells)
+    counts = np.bincount(groups, minlength=n)
+    dwell = np.bincount(groups, weights=durations, minlength=n)
+    has_speed = ~np.isnan(speed)
+    speed_sum = np.bincount(groups[has_speed], weights=speed[has_speed], minlength=n)
+    speed_count = np.bincount(groups[has_speed], minlength=n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_speed = speed_sum / speed_count
+    max_speed = _group_max(speed, groups, n)
+
+    if shape == "hex":
+        center_x = size * (math.sqrt(3) * unique_cells[:, 0] + math.sqrt(3) / 2 * unique_cells[:, 1])
+        center_y = size * 1.5 * unique_cells[:, 1]
+    else:
+        center_x = (unique_cells[:, 0] + 0.5) * resolution_m
+        center_y = (unique_cells[:, 1] + 0.5) * resolution_m
+
+    cells_out = [
+        {
+            "longitude": round(float(cx / x_scale), 6),
+            "latitude": round(float(cy / METERS_PER_DEGREE), 6),
+            "count": int(c),
+            "dwellSeconds": round(float(d), 1),
+            "meanSpeed": ms,
+            "maxSpeed": mx,
+        }
+        for cx, cy, c, d, ms, mx in zip(
+            center_x, center_y, counts, dwell, _round_or_none(mean_speed), _round_or_none(max_speed)
+        )
+    ]
+
+    return {
+        "shape": shape,
+        "resolutionMeters": resolution_m,
+        "totalPoints": int(len(rows)),
+        "totalCells": n,
+        "cells": cells_out,
+    }
+
+
+def dwell_time(
+    index: TelemetryIndex,
+    plates: Optional[List[str]],
+    start_ns: Optional[int],
+    end_ns: Optional[int],
+    by: str = "location",
+) -> dict:
+    """Time spent per locationName (by="location") or per Position de la Cabine (by="cabine")"""
+    key = ("dwell", tuple(plates) if plates else None, start_ns, end_ns, by)
+    return cached(index, key, lambda: _dwell_time(index, plates, start_ns, end_ns, by))
+
+
+def _dwell_time(index, plates, start_ns, end_ns, by) -> dict:
+    rows = index.select_rows(plates, start_ns, end_ns)
+    durations = sample_durations(index, rows)
+    codes, names = pd.factorize(index.df[DWELL_COLUMNS[by]].to_numpy()[rows])
+
+    known = codes >= 0
+    codes, durations = codes[known], durations[known]
+    plate_codes = index.plate_codes[rows][known]
+    n = len(names)
+
+    dwell = np.bincount(codes, weights=durations, minlength=n)
+    samples = np.bincount(codes, minlength=n)
+    # Distinct (group, plate) pairs give the number of vehicles seen in each group
+    n_plates = max(len(index.plate_names), 1)
+    pairs = np.unique(codes.astype(np.int64) * n_plates + plate_codes)
+    vehicles = np.bincount(pairs // n_plates, minlength=n)
+
+    order = np.argsort(-dwell, kind="stable")
+    return {
+        "groupBy": by,
+        "total": n,
+        "items": [
+            {
+                "name": str(names[i]),
+                "dwellSeconds": round(float(dwell[i]), 1),
+                "samples": int(samples[i]),
+                "vehicles": int(vehicles[i]),
+            }
+            for i in order
+        ],
+    }
+
+
+def engine_time(
+    index: TelemetryIndex,
+    plates: Optional[List[str]],
+    start_ns: Optional[int],
+    end_ns: Optional[int],
+) -> dict:
+    """Idle-engine time per plate, with the time spent in every engineState"""
+    key = ("engine", tuple(plates) if plates else None, start_ns, end_ns)
+    return cached(index, key, lambda: _engine_time(index, plates, start_ns, end_ns))
+
+
+def _engine_time(index, plates, start_ns, end_ns) -> dict:
+    rows = index.select_rows(plates, start_ns, end_ns)
+    durations = sample_durations(index, rows)
+    state_codes, states = pd.factorize(index.df["engineState"].to_numpy()[rows])
+
+    known = state_codes >= 0
+    plate_codes = index.plate_codes[rows][known]
+    n_plates, n_states = len(index.plate_names), len(states)
+    per_state = np.bincount(
+        plate_codes * n_states + state_codes[known],
+        weights=durations[known],
+        minlength=n_plates * n_states,
+    ).reshape(n_plates, n_states)
+
+    idle_column = list(states).index(IDLE_ENGINE_STATE) if IDLE_ENGINE_STATE in list(states) else None
+    present = np.flatnonzero(np.bincount(index.plate_codes[rows], minlength=n_plates))
+
+    items = []
+    for p in present:
+        total = float(per_state[p].sum())
+        idle = float(per_state[p, idle_column]) if idle_column is not None else 0.0
+        items.append({
+            "plateNumber": str(index.plate_names[p]),
+            "idleSeconds": round(idle, 1),
+            "idleRatio": round(idle / total, 4) if total else None,
+            "stateSeconds": {str(s): round(float(per_state[p, i]), 1) for i, s in enumerate(states)},
+        })
+    items.sort(key=lambda item: item["idleSeconds"], reverse=True)
+
+    return {"total": len(items), "items": items}
@@ -0,0 +1,233 @@
+import base64
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Grid cell size for the spatial index (~200 m of latitude)
+GRID_CELL_DEGREES = 0.002
+
+# Output field names, same as CoordinateData in main.py
+OUTPUT_FIELDS = {
+    "dateProcessed": "timestamp",
+    "longitude": "longitude",
+    "latitude": "latitude",
+    "plateNumber": "plateNumber",
+    "speed": "speed",
+    "heading": "heading",
+    "engineState": "engineState",
+    "locationName": "locationName",
+    "Position de la Cabine": "cabinePosition",
+    "territoriesName": "territoriesName",
+    "enterTerritories": "enterTerritories",
+    "exitTerritories": "exitTerritories",
+    "VehicleAvailabilityEvent_AvailabilityStateType": "availabilityState",
+}
+
+
+def to_ns(value: str) -> int:
+    """Parse an ISO timestamp to naive-UTC nanoseconds (same convention as the ingest API)"""
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert("UTC").tz_localize(None)
+    return int(ts.as_unit("ns").value)
+
+
+def encode_cursor(ts_ns: int, offset: int) -> str:
+    return base64.urlsafe_b64encode(f"{ts_ns}:{offset}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, int]:
+    """Raises ValueError for malformed cursors"""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    ts_ns, offset = base64.urlsafe_b64decode(padded.encode()).decode().split(":")
+    return int(ts_ns), int(offset)
+
+
+class TelemetryIndex:
+    """Read-only indexes over a cleaned, time-sorted telemetry frame.
+
+    Because rows are sorted by `dateProcessed`, a row number is also a time
+    order: time ranges become row ranges, and the per-plate / per-territory
+    indexes are just sorted arrays of row numbers. The spatial index is a
+    uniform lon/lat grid: rows sorted by (cell, row), so each cell's rows are
+    in time order and a bounding box page only reads, per overlapped cell,
+    the first rows after the cursor.
+    """
+
+    def __init__(self, df: pd.DataFrame, cell_degrees: float = GRID_CELL_DEGREES):
+        self.df = df.reset_index(drop=True)
+        self.ts = self.df["dateProcessed"].to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        if len(self.ts) > 1 and (np.diff(self.ts) < 0).any():
+            raise ValueError("TelemetryIndex expects rows sorted by dateProcessed")
+
+        self.lon = self.df["longitude"].to_numpy(dtype=np.float64)
+        self.lat = self.df["latitude"].to_numpy(dtype=np.float64)
+
+        self.plate_codes, self.plate_names = pd.factorize(self.df["plateNumber"])
+        self.plate_rows: Dict[str, np.ndarray] = {
+            str(plate): rows for plate, rows in self.df.groupby("plateNumber", sort=False).indices.items()
+        }
+        # A row inside several territories lists them all (e.g. "K01|K05") and is indexed under each
+        names = self.df["territoriesName"].dropna().astype(str).str.split("|").explode().str.strip()
+        names = names[names != ""]
+        self.territory_rows: Dict[str, np.ndarray] = {
+            str(name): np.unique(rows.to_numpy(dtype=np.int64))
+            for name, rows in names.groupby(names).groups.items()
+        }
+
+        self.cell_degrees = cell_degrees
+        cx = np.floor(self.lon / cell_degrees).astype(np.int64)
+        cy = np.floor(self.lat / cell_degrees).astype(np.int64)
+        self.cx_min = int(cx.min()) if len(cx) else 0
+        self.cy_min = int(cy.min()) if len(cy) else 0
+        self.nx = int(cx.max()) - self.cx_min + 1 if len(cx) else 0
+        self.ny = int(cy.max()) - self.cy_min + 1 if len(cy) else 0
+        keys = (cx - self.cx_min) * self.ny + (cy - self.cy_min)
+        self.grid_rows = np.argsort(keys, kind="stable")
+        # key * n + row increases along grid_rows, so one search finds a time bound inside a cell
+        self.grid_order = keys[self.grid_rows] * len(keys) + self.grid_rows
+        self.cell_keys = np.unique(keys)
+
+        # Results of telemetry_analytics, dropped together with the index when data changes
+        self.aggregate_cache: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def time_range(self, start_ns: Optional[int] = None, end_ns: Optional[int] = None) -> Tuple[int, int]:
+        """Row range [lo, hi) covering start_ns <= dateProcessed <= end_ns"""
+        lo = 0 if start_ns is None else int(np.searchsorted(self.ts, start_ns, side="left"))
+        hi = len(self.ts) if end_ns is None else int(np.searchsorted(self.ts, end_ns, side="right"))
+        return lo, hi
+
+    def select_rows(
+        self,
+        plates: Optional[List[str]] = None,
+        start_ns: Optional[int] = None,
+        end_ns: Optional[int] = None,
+    ) -> np.ndarray:
+        """All rows in the time range, optionally restricted to some plates, in time order"""
+        lo, hi = self.time_range(start_ns, end_ns)
+        if plates is None:
+            return np.arange(lo, hi, dtype=np.int64)
+        return self._plate_rows(plates, lo, hi)
+
+    def _plate_rows(self, plates: List[str], lo: int, hi: int) -> np.ndarray:
+        parts = [
+            self._time_rows(self.plate_rows[p], lo, hi)
+            for p in dict.fromkeys(plates) if p in self.plate_rows
+        ]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    def _time_rows(self, rows: np.ndarray, lo: int, hi: int) -> np.ndarray:
+        """Slice a sorted row array to the [lo, hi) row range"""
+        return rows[np.searchsorted(rows, lo):np.searchsorted(rows, hi)]
+
+    def _inside(self, rows: np.ndarray, bbox: Tuple[float, float, float, float]) -> np.ndarray:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        lon, lat = self.lon[rows], self.lat[rows]
+        return (lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)
+
+    def _bbox_rows(self, bbox: Tuple[float, float, float, float], lo: int, hi: int, need: int) -> np.ndarray:
+        """First `need` rows of [lo, hi) inside the box, in time order"""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        bx0 = int(np.floor(min_lon / self.cell_degrees)) - self.cx_min
+        bx1 = int(np.floor(max_lon / self.cell_degrees)) - self.cx_min
+        by0 = int(np.floor(min_lat / self.cell_degrees)) - self.cy_min
+        by1 = int(np.floor(max_lat / self.cell_degrees)) - self.cy_min
+        cx0, cx1 = max(bx0, 0), min(bx1, self.nx - 1)
+        cy0, cy1 = max(by0, 0), min(by1, self.ny - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.int64)
+
+        # Non-empty cells of each overlapped grid column (a contiguous key range)
+        column_keys = np.arange(cx0, cx1 + 1, dtype=np.int64) * self.ny
+        first = np.searchsorted(self.cell_keys, column_keys + cy0, side="left")
+        last = np.searchsorted(self.cell_keys, column_keys + cy1, side="right")
+        cells = self.cell_keys[np.concatenate([np.arange(a, b) for a, b in zip(first, last)])]
+
+        # Rows of each cell within [lo, hi)
+        starts = np.searchsorted(self.grid_order, cells * len(self.ts) + lo)
+        ends = np.searchsorted(self.grid_order, cells * len(self.ts) + hi)
+        # Cells strictly between the border cells are entirely inside the box
+        cell_x, cell_y = cells // self.ny, cells % self.ny
+        interior = (cell_x > bx0) & (cell_x < bx1) & (cell_y > by0) & (cell_y < by1)
+
+        # The first `need` matches overall are among the first `need` of each cell
+        parts = []
+        for s, e, whole in zip(starts, ends, interior):
+            if e <= s:
+                continue
+            if whole:
+                parts.append(self.grid_rows[s:min(e, s + need)])
+                continue
+            # Border cell: check rows in growing chunks until `need` are inside
+            found, step = 0, need
+            while s < e and found < need:
+                chunk = self.grid_rows[s:min(e, s + step)]
+                chunk = chunk[self._inside(chunk, bbox)]
+                parts.append(chunk)
+                found += len(chunk)
+                s, step = s + step, step * 2
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(parts))[:need]
+
+    def query(
+        self,
+        plates: Optional[List[str]] = None,
+        start_ns: Optional[int] = None,
+        end_ns: Optional[int] = None,
+        bbox: Optional[Tuple[float, float, float, float]] = None,
+        territory: Optional[str] = None,
+        cursor: Optional[str] = None,
+        limit: int = 1000,
+    ) -> Tuple[np.ndarray, Optional[str]]:
+        """Return up to `limit` matching row numbers in time order and the cursor for the next page"""
+        lo, hi = self.time_range(start_ns, end_ns)
+
+        if cursor:
+            # The cursor is (timestamp, position among rows sharing it) so it survives index rebuilds
+            cursor_ts, offset = decode_cursor(cursor)
+            lo = max(lo, int(np.searchsorted(self.ts, cursor_ts, side="left")) + offset + 1)
+
+        if lo >= hi:
+            return np.empty(0, dtype=np.int64), None
+
+        candidates = []
+        if plates is not None:
+            candidates.append(self._plate_rows(plates, lo, hi))
+        if territory is not None:
+            rows = self.territory_rows.get(territory)
+            candidates.append(self._time_rows(rows, lo, hi) if rows is not None else np.empty(0, dtype=np.int64))
+
+        if candidates:
+            candidates.sort(key=len)
+            rows = candidates[0]
+            for other in candidates[1:]:
+                rows = np.intersect1d(rows, other, assume_unique=True)
+            if bbox is not None:
+                rows = rows[self._inside(rows, bbox)]
+            rows = rows[:limit + 1]
+        elif bbox is not None:
+            rows = self._bbox_rows(bbox, lo, hi, limit + 1)
+        else:
+            rows = np.arange(lo, min(hi, lo + limit + 1), dtype=np.int64)
+
+        if len(rows) <= limit:
+            return rows, None
+
+        rows = rows[:limit]
+        last = int(rows[-1])
+        last_ts = int(self.ts[last])
+        offset = last - int(np.searchsorted(self.ts, last_ts, side="left"))
+        return rows, encode_cursor(last_ts, offset)
+
+    def iter_ndjson(self, rows: np.ndarray, chunk_size: int = 1000) -> Iterator[str]:
+        """Serialize rows as NDJSON in chunks, with the same field names as the stream endpoints"""
+        for start in range(0, len(rows), chunk_size):
+            chunk = self.df.iloc[rows[start:start + chunk_size]][list(OUTPUT_FIELDS)]
+            chunk = chunk.rename(columns=OUTPUT_FIELDS)
+            yield chunk.to_json(orient="records", lines=True, date_format="iso", force_ascii=False).rstrip("\n") + "\n"
@@ -0,0 +1,401 @@
+import json
+import os
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Columns kept for every telemetry point (same names as telemetry_expanded.csv)
+TELEMETRY_COLUMNS = [
+    "dateProcessed", "longitude", "latitude", "speed",
+    "heading", "engineState", "plateNumber", "locationName",
+    "Position de la Cabine", "territoriesName", "enterTerritories", "exitTerritories",
+    "VehicleAvailabilityEvent_AvailabilityStateType",
+]
+
+INGEST_COLUMNS = TELEMETRY_COLUMNS + ["gpsProvider"]
+
+FLOAT_COLUMNS = ["longitude", "latitude", "speed", "heading"]
+TEXT_COLUMNS = [
+    "plateNumber", "engineState", "locationName", "Position de la Cabine",
+    "territoriesName", "enterTerritories", "exitTerritories", "gpsProvider",
+    "VehicleAvailabilityEvent_AvailabilityStateType",
+]
+
+# API-style field names accepted in ingested points, mapped to CSV columns.
+# `date` (GPS fix time) is deliberately not an alias: it is a different time base.
+FIELD_ALIASES = {
+    "timestamp": "dateProcessed",
+    "cabinePosition": "Position de la Cabine",
+    "availabilityState": "VehicleAvailabilityEvent_AvailabilityStateType",
+}
+
+SPILL_DIR = Path(os.environ.get(
+    "TELEMETRY_SPILL_DIR", Path(__file__).parent.parent / "telemetry_spill"
+))
+WINDOW_SECONDS = int(os.environ.get("TELEMETRY_WINDOW_SECONDS", "60"))
+WINDOW_CAPACITY = int(os.environ.get("TELEMETRY_WINDOW_CAPACITY", "65536"))
+RING_SIZE = int(os.environ.get("TELEMETRY_RING_SIZE", "8"))
+# Spilled windows kept in memory for the live read paths; older ones are only on disk
+RETAINED_WINDOWS = int(os.environ.get("TELEMETRY_RETAINED_WINDOWS", "60"))
+# How many windows behind the newest one stay open for late points
+LATENESS_WINDOWS = 1
+
+
+def parse_ingest_body(body: bytes) -> Tuple[Dict[str, np.ndarray], int]:
+    """Parse an NDJSON or JSON-array batch and validate it column-wise.
+
+    Returns the valid points as column arrays plus the number of rejected points.
+    Raises ValueError when the body is not valid JSON/NDJSON.
+    """
+    text = body.decode("utf-8").strip()
+    if not text:
+        return empty_batch(), 0
+
+    if text[0] == "[":
+        records = json.loads(text)
+    else:
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    points = [r for r in records if isinstance(r, dict)]
+    rejected = len(records) - len(points)
+    if not points:
+        return empty_batch(), rejected
+
+    df = pd.DataFrame.from_records(points)
+    # Points of one batch may use either name, so fill per point rather than renaming the column
+    for alias, column in FIELD_ALIASES.items():
+        if alias in df.columns:
+            df[column] = df[column].fillna(df[alias]) if column in df.columns else df[alias]
+    df = df.reindex(columns=INGEST_COLUMNS)
+
+    # ISO8601 lets every point carry its own precision and offset instead of
+    # inferring one format from the first point
+    timestamps = pd.to_datetime(df["dateProcessed"], errors="coerce", utc=True, format="ISO8601")
+    longitude = pd.to_numeric(df["longitude"], errors="coerce")
+    latitude = pd.to_numeric(df["latitude"], errors="coerce")
+    plate = df["plateNumber"]
+
+    # Same rules as the CSV cleaning: timestamp, coordinates and plate required, no zero coordinates
+    valid = (
+        timestamps.notna()
+        & longitude.between(-180, 180) & (longitude != 0)
+        & latitude.between(-90, 90) & (latitude != 0)
+        & plate.notna() & (plate.astype(str).str.strip() != "")
+    ).to_numpy()
+
+    rejected += int((~valid).sum())
+    if not valid.any():
+        return empty_batch(), rejected
+
+    batch = {
+        "dateProcessed": timestamps[valid].dt.tz_localize(None)
+        .to_numpy(dtype="datetime64[ns]").astype(np.int64),
+    }
+    for column in FLOAT_COLUMNS:
+        batch[column] = pd.to_numeric(df[column][valid], errors="coerce").to_numpy(dtype=np.float64)
+    for column in TEXT_COLUMNS:
+        values = df[column][valid]
+        batch[column] = np.where(values.notna(), values.astype(str), None).astype(object)
+
+    return batch, rejected
+
+
+def empty_batch() -> Dict[str, np.ndarray]:
+    batch = {"dateProcessed": np.empty(0, dtype=np.int64)}
+    for column in FLOAT_COLUMNS:
+        batch[column] = np.empty(0, dtype=np.float64)
+    for column in TEXT_COLUMNS:
+        batch[column] = np.empty(0, dtype=object)
+    return batch
+
+
+def empty_frame() -> pd.DataFrame:
+    return batch_to_frame(empty_batch())
+
+
+def batch_to_frame(batch: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """Build a DataFrame with the CSV column names from column arrays (copies the data)"""
+    data = {"dateProcessed": batch["dateProcessed"].astype("datetime64[ns]")}
+    for column in FLOAT_COLUMNS:
+        data[column] = batch[column].copy()
+    for column in TEXT_COLUMNS:
+        data[column] = pd.Series(batch[column], dtype=object, copy=True)
+    return pd.DataFrame(data, columns=INGEST_COLUMNS)
+
+
+class TelemetryWindow:
+    """Preallocated columnar slot holding the points of one time window"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.columns = empty_batch()
+        self.columns["dateProcessed"] = np.empty(capacity, dtype=np.int64)
+        for column in FLOAT_COLUMNS:
+            self.columns[column] = np.empty(capacity, dtype=np.float64)
+        for column in TEXT_COLUMNS:
+            self.columns[column] = np.empty(capacity, dtype=object)
+        self.key: Optional[int] = None
+        self.size = 0
+
+    def reset(self, key: Optional[int]):
+        # Drop references to the previous window's strings before reuse
+        for column in TEXT_COLUMNS:
+            self.columns[column][:self.size] = None
+        self.key = key
+        self.size = 0
+
+    @property
+    def full(self) -> bool:
+        return self.size >= self.capacity
+
+    def write(self, batch: Dict[str, np.ndarray], rows: np.ndarray) -> int:
+        """Copy as many of `rows` as fit; returns how many were written"""
+        count = min(len(rows), self.capacity - self.size)
+        if count:
+            taken = rows[:count]
+            end = self.size + count
+            for column, values in self.columns.items():
+                values[self.size:end] = batch[column][taken]
+            self.size = end
+        return count
+
+    def view(self) -> Dict[str, np.ndarray]:
+        return {column: values[:self.size] for column, values in self.columns.items()}
+
+
+class TelemetryStore:
+    """Ring of preallocated time windows fed by the ingest API.
+
+    Points are bucketed by `dateProcessed` into fixed-size windows. A window is
+    sealed when it fills up, when it falls more than LATENESS_WINDOWS behind the
+    newest window, or when its slot is needed; sealed windows are copied out
+    and spilled to CSV files in SPILL_DIR by `spill_pending`. The last
+    `retained_windows` spilled windows stay in memory so the replay, query
+    and analytics endpoints keep seeing recent data. The spill files hold
+    the full history, but the read endpoints only see memory:
+    `truncated_before` is the end of the newest window dropped from memory,
+    before which ingested points may be missing from their results.
+    """
+
+    def __init__(
+        self,
+        spill_dir: Path = SPILL_DIR,
+        window_seconds: int = WINDOW_SECONDS,
+        window_capacity: int = WINDOW_CAPACITY,
+        ring_size: int = RING_SIZE,
+        retained_windows: int = RETAINED_WINDOWS,
+    ):
+        self.spill_dir = Path(spill_dir)
+        self.window_ns = window_seconds * 1_000_000_000
+        self._slots = [TelemetryWindow(window_capacity) for _ in range(ring_size)]
+        self._free: List[TelemetryWindow] = list(self._slots)
+        self._open: Dict[int, TelemetryWindow] = {}
+        self._pending: Dict[Path, pd.DataFrame] = {}
+        self._writing: set = set()
+        self._archive: deque = deque(maxlen=retained_windows)
+        self._archive_frame: Optional[pd.DataFrame] = None
+        self._max_key: Optional[int] = None
+        self._spill_seq = 0
+        self._truncated_before: Optional[pd.Timestamp] = None
+        self._lock = threading.Lock()
+        self.version = 0
+        self.points_ingested = 0
+        self.windows_sealed = 0
+        self.windows_spilled = 0
+
+    def load_spilled(self):
+        """Load the most recent windows spilled by previous runs back into memory"""
+        if not self.spill_dir.exists():
+            return
+
+        # File names start with the window start time, so name order is time order
+        paths = sorted(self.spill_dir.glob("telemetry_*.csv"))
+        last_seq = 0
+        for path in paths:
+            try:
+                last_seq = max(last_seq, int(path.stem.rsplit("_", 1)[1]))
+            except ValueError:
+                continue
+
+        skipped = paths[:max(len(paths) - self._archive.maxlen, 0)]
+        truncated_before = None
+        for path in skipped:
+            try:
+                start = pd.to_datetime(path.stem.split("_")[1], format="%Y%m%dT%H%M%S")
+            except (IndexError, ValueError):
+                continue
+            end = start + pd.Timedelta(self.window_ns, unit="ns")
+            truncated_before = end if truncated_before is None else max(truncated_before, end)
+
+        frames = []
+        for path in paths[len(skipped):]:
+            try:
+                # reindex so files written before a column was added still load
+                frame = pd.read_csv(path, dtype={c: object for c in TEXT_COLUMNS}).reindex(columns=INGEST_COLUMNS)
+                frame["dateProcessed"] = pd.to_datetime(frame["dateProcessed"], errors="coerce")
+                frames.append(frame)
+            except Exception as e:
+                print(f"❌ Error loading spilled window {path.name}: {e}")
+
+        with self._lock:
+            self._spill_seq = max(self._spill_seq, last_seq)
+            self._truncate(truncated_before)
+            if frames:
+                self._archive.extend(frames)
+                self._archive_frame = None
+                self.version += 1
+        if frames:
+            print(f"📦 Loaded {len(frames)} of {len(paths)} spilled telemetry windows from {self.spill_dir}")
+
+    def append(self, batch: Dict[str, np.ndarray]) -> int:
+        """Append validated column arrays; returns the number of windows sealed"""
+        count = len(batch["dateProcessed"])
+        if not count:
+            return 0
+
+        keys = batch["dateProcessed"] // self.window_ns
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        bounds = np.flatnonzero(np.diff(sorted_keys)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [count]))
+
+        with self._lock:
+            sealed = self.windows_sealed
+            for start, end in zip(starts, ends):
+                key = int(sorted_keys[start])
+                rows = order[start:end]
+                while len(rows):
+                    window = self._window_for(key)
+                    rows = rows[window.write(batch, rows):]
+                    if window.full:
+                        self._seal(window)
+
+            newest = int(sorted_keys[-1])
+            if self._max_key is None or newest > self._max_key:
+                self._max_key = newest
+            for key in sorted(self._open):
+                if key < self._max_key - LATENESS_WINDOWS:
+                    self._seal(self._open[key])
+
+            self.points_ingested += count
+            self.version += 1
+            return self.windows_sealed - sealed
+
+    def _window_for(self, key: int) -> TelemetryWindow:
+        window = self._open.get(key)
+        if window is not None:
+            return window
+        if not self._free:
+            self._seal(self._open[min(self._open)])
+        window = self._free.pop()
+        window.reset(key)
+        self._open[key] = window
+        return window
+
+    def _seal(self, window: TelemetryWindow):
+        """Copy a window out for spilling and return its slot to the free list (lock held)"""
+        frame = batch_to_frame(window.view())
+        start = pd.Timestamp(window.key * self.window_ns)
+        self._spill_seq += 1
+        path = self.spill_dir / f"telemetry_{start:%Y%m%dT%H%M%S}_{self._spill_seq:06d}.csv"
+        self._pending[path] = frame
+        del self._open[window.key]
+        window.reset(None)
+        self._free.append(window)
+        self.windows_sealed += 1
+
+    def seal_all(self):
+        """Seal every open window (used on shutdown before the final spill)"""
+        with self._lock:
+            for key in sorted(self._open):
+                self._seal(self._open[key])
+            self.version += 1
+
+    def spill_pending(self):
+        """Write sealed windows to disk; meant to run off the event loop"""
+        with self._lock:
+            jobs = [(path, frame) for path, frame in self._pending.items() if path not in self._writing]
+            self._writing.update(path for path, _ in jobs)
+
+        for path, frame in jobs:
+            try:
+                self.spill_dir.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(".tmp")
+                frame.to_csv(tmp_path, index=False)
+                os.replace(tmp_path, path)
+                with self._lock:
+                    # The deque drops the oldest retained window once it is full
+                    evicted = len(self._archive) == self._archive.maxlen
+                    if evicted:
+                        self._truncate(self._window_end(self._archive[0]))
+                    self._archive.append(self._pending.pop(path))
+                    self._archive_frame = None
+                    self.windows_spilled += 1
+                    if evicted:
+                        self.version += 1
+                print(f"💾 Spilled {len(frame)} points to {path.name}")
+            except Exception as e:
+                # Keep it pending so the data stays visible and the next spill retries it
+                print(f"❌ Error spilling {path.name}: {e}")
+            finally:
+                with self._lock:
+                    self._writing.discard(path)
+
+    def _window_end(self, frame: pd.DataFrame) -> Optional[pd.Timestamp]:
+        """End of the time window a spilled frame belongs to"""
+        first = frame["dateProcessed"].min()
+        if pd.isna(first):
+            return None
+        key = pd.Timestamp(first).as_unit("ns").value // self.window_ns
+        return pd.Timestamp((key + 1) * self.window_ns)
+
+    def _truncate(self, end: Optional[pd.Timestamp]):
+        """Record that ingested points before `end` were dropped from memory (lock held)"""
+        if end is not None and (self._truncated_before is None or end > self._truncated_before):
+            self._truncated_before = end
+
+    @property
+    def truncated_before(self) -> Optional[pd.Timestamp]:
+        """Ingested points older than this may only be in the spill files (None if nothing was dropped)"""
+        with self._lock:
+            return self._truncated_before
+
+    def frame(self) -> pd.DataFrame:
+        """Ingested points in memory (retained, pending and open windows) as one DataFrame"""
+        with self._lock:
+            # Retained windows only change on spill, so their concatenation is reused
+            if self._archive_frame is None:
+                self._archive_frame = (
+                    pd.concat(self._archive, ignore_index=True) if self._archive else empty_frame()
+                )
+            parts = [self._archive_frame] + list(self._pending.values())
+            parts += [batch_to_frame(w.view()) for w in self._open.values() if w.size]
+
+        parts = [p for p in parts if not p.empty]
+        if not parts:
+            return empty_frame()
+        return pd.concat(parts, ignore_index=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pointsIngested": self.points_ingested,
+                "openWindows": len(self._open),
+                "bufferedPoints": sum(w.size for w in self._open.values()),
+                "pendingWindows": len(self._pending),
+                "windowsSealed": self.windows_sealed,
+                "windowsSpilled": self.windows_spilled,
+                "retainedWindows": len(self._archive),
+                "truncatedBefore": self._truncated_before.isoformat() if self._truncated_before is not None else None,
+                "windowSeconds": self.window_ns // 1_000_000_000,
+                "ringSize": len(self._slots),
+            }
+
+
+# Shared store used by the ingest endpoint and the telemetry read paths
+store = TelemetryStore()
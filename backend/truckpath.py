@@ -1,11 +1,15 @@
 from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from typing import List, Tuple
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Tuple
 import geopandas as gpd
 import networkx as nx
-from shapely.geometry import LineString
+import numpy as np
+from shapely.geometry import LineString, Point, mapping
+import shapely
+import heapq
 import math
 import os
+import re
 
 router = APIRouter()
 
@@ -29,25 +33,77 @@ class ETAResponse(BaseModel):
     average_speed_kmh: float
     message: str
 
+class IsochroneRequest(BaseModel):
+    origin: Tuple[float, float]  # (lon, lat)
+    max_minutes: float = Field(gt=0, le=120)
+    locations: List[Stop] = []  # Registered locations to check for reachability
+
+class ReachableLocation(BaseModel):
+    name: str
+    coordinates: Tuple[float, float]  # (lon, lat)
+    time_minutes: float
+
+class IsochroneResponse(BaseModel):
+    origin_node: Tuple[float, float]
+    max_minutes: float
+    reachable_nodes: int
+    polygon: dict  # GeoJSON geometry of the reachable road network
+    locations: List[ReachableLocation]
+    message: str
+
 # Global graph variable to avoid rebuilding on every request
 G = None
 gdf = None
 
+# Node coordinates as arrays for vectorized snapping, in the order of node_list
+indexed_graph = None
+node_list = []
+node_lons = None
+node_lats = None
+# Connected component id of every node, to tell unreachable vehicles apart without searching
+node_component: Dict[Tuple[float, float], int] = {}
+# Snapped node per registered location coordinate (locations rarely move)
+snap_cache: Dict[Tuple[float, float], Tuple[float, float]] = {}
+
 # Default truck speed if maxspeed not available (km/h)
 DEFAULT_SPEED_KMH = 20
+MILE_KM = 1.609344
+
+# Points farther than this from every road node are treated as off the network
+MAX_SNAP_METERS = 500
+
+# Width added around reachable roads when drawing the isochrone polygon (~25 m)
+ISOCHRONE_BUFFER_DEGREES = 0.00025
+
+def parse_speed_kmh(speed):
+    """Read a maxspeed value as km/h, or None if it is missing or invalid"""
+    if isinstance(speed, (list, tuple, np.ndarray)):
+        # OSM ways merged from several roads list every limit (e.g. ['50', '30']); keep the lowest
+        values = [v for v in (parse_speed_kmh(s) for s in speed) if v is not None]
+        return min(values) if values else None
+    factor = 1.0
+    if isinstance(speed, str):
+        # First number only, in km/h unless mph follows it (e.g. "50;30" -> 50, "30 mph" -> 48.3)
+        match = re.search(r"\d+(\.\d+)?", speed)
+        if match and re.match(r"\s*mph", speed[match.end():], re.IGNORECASE):
+            factor = MILE_KM
+        speed = match.group() if match else None
+    try:
+        value = float(speed) * factor
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) and value > 0 else None
 
 def speed_to_mps(speed):
     """Convert speed to meters per second"""
-    if speed is None:
-        speed = DEFAULT_SPEED_KMH
-    elif isinstance(speed, str):
-        # Extract digits from speed string (e.g., "30 km/h" -> 30)
-        speed = int(''.join(c for c in speed if c.isdigit()))
-    return speed / 3.6  # Convert km/h to m/s
+    kmh = parse_speed_kmh(speed)
+    if kmh is None:
+        kmh = DEFAULT_SPEED_KMH
+    return kmh / 3.6  # Convert km/h to m/s
 
 def initialize_graph():
     """Initialize the graph from GeoJSON data - exactly like the Colab code"""
-    global G, gdf
+    global G, gdf, indexed_graph, node_list, node_lons, node_lats, node_component
     
     try:
         # Get the path to the GeoJSON file
@@ -73,10 +129,21 @@ def initialize_graph():
         for _, row in gdf.iterrows():
             if isinstance(row.geometry, LineString):
                 coords = list(row.geometry.coords)
+                # Travel time (seconds) from the road's maxspeed, used by the isochrone
+                speed_mps = speed_to_mps(row.get("maxspeed"))
                 for i in range(len(coords)-1):
                     (x1, y1), (x2, y2) = coords[i], coords[i+1]
                     dist = haversine(x1, y1, x2, y2)
-                    G.add_edge((x1, y1), (x2, y2), weight=dist)
+                    G.add_edge((x1, y1), (x2, y2), weight=dist, travel_time=dist / speed_mps)
+        
+        indexed_graph = G
+        node_list = list(G.nodes)
+        node_lons = np.array([n[0] for n in node_list])
+        node_lats = np.array([n[1] for n in node_list])
+        node_component = {
+            node: i for i, nodes in enumerate(nx.connected_components(G)) for node in nodes
+        }
+        snap_cache.clear()
         
         print(f"Graph built with {len(G.nodes)} nodes and {len(G.edges)} edges")
         return True
@@ -88,8 +155,63 @@ def initialize_graph():
 def nearest_node(G, point):
     """Find the nearest node in the graph to a given point - exactly like the Colab code"""
     lon, lat = point
+    if G is indexed_graph and len(node_list) == len(G.nodes):
+        # Same haversine argmin, vectorized over the cached node arrays
+        phi1, phi2 = math.radians(lat), np.radians(node_lats)
+        dphi = phi2 - phi1
+        dlambda = np.radians(node_lons - lon)
+        a = np.sin(dphi/2)**2 + math.cos(phi1)*np.cos(phi2)*np.sin(dlambda/2)**2
+        return node_list[int(np.argmin(a))]
     return min(G.nodes, key=lambda n: haversine(lon, lat, n[0], n[1]))
 
+def nearest_nodes(points, chunk_size=256):
+    """nearest_node for many points at once (haversine argmin in chunks of points)"""
+    if indexed_graph is not G or len(node_list) != len(G.nodes):
+        return [nearest_node(G, p) for p in points]
+    
+    result = []
+    phi2 = np.radians(node_lats)
+    for start in range(0, len(points), chunk_size):
+        chunk = np.asarray(points[start:start + chunk_size], dtype=float).reshape(-1, 2)
+        phi1 = np.radians(chunk[:, 1])[:, None]
+        dphi = phi2[None, :] - phi1
+        dlambda = np.radians(node_lons[None, :] - chunk[:, 0][:, None])
+        a = np.sin(dphi/2)**2 + np.cos(phi1)*np.cos(phi2)[None, :]*np.sin(dlambda/2)**2
+        result.extend(node_list[i] for i in np.argmin(a, axis=1))
+    return result
+
+def snap_location(point):
+    """nearest_node for registered locations, cached by coordinates"""
+    key = (float(point[0]), float(point[1]))
+    if key not in snap_cache:
+        snap_cache[key] = nearest_node(G, key)
+    return snap_cache[key]
+
+def reachable_polygon(travel_times, max_seconds):
+    """GeoJSON polygon covering the road network reachable within max_seconds.
+
+    Edges leaving a reachable node are drawn up to the fraction that can be
+    driven in the remaining time, then the lines are buffered into an area.
+    Buffering thousands of two-point segments one by one is slow, so they are
+    merged into as few linestrings as possible first.
+    """
+    lines = []
+    for u, t_u in travel_times.items():
+        remaining = max_seconds - t_u
+        for v, data in G[u].items():
+            edge_time = data.get("travel_time", 0)
+            fraction = min(1.0, remaining / edge_time) if edge_time > 0 else 1.0
+            end = (u[0] + fraction * (v[0] - u[0]), u[1] + fraction * (v[1] - u[1]))
+            if end != u:
+                lines.append((u, end))
+    
+    if lines:
+        merged = shapely.line_merge(shapely.unary_union(shapely.linestrings(lines)))
+        shape = merged.buffer(ISOCHRONE_BUFFER_DEGREES, quad_segs=4)
+    else:
+        shape = Point(next(iter(travel_times))).buffer(ISOCHRONE_BUFFER_DEGREES)
+    return mapping(shape.simplify(ISOCHRONE_BUFFER_DEGREES / 5))
+
 def haversine(lon1, lat1, lon2, lat2):
     """Calculate haversine distance between two points - exactly like the Colab code"""
     R = 6371000
@@ -103,6 +225,73 @@ def heuristic(n1, n2):
     """Heuristic function for A* algorithm - exactly like the Colab code"""
     return haversine(n1[0], n1[1], n2[0], n2[1])
 
+def nearest_vehicles(target, vehicles, k, max_seconds: Optional[float] = None):
+    """Rank vehicles by ETA to a target with a single reverse Dijkstra.
+
+    `vehicles` is a list of (lon, lat) positions. A vehicle's ETA is the road
+    time from its snapped node plus the leg from its GPS fix to that node at
+    DEFAULT_SPEED_KMH. The graph is undirected, so road times from the target
+    equal times to it. Since ETA >= road time, the search can stop once the
+    next node's road time reaches the k-th best ETA found (or max_seconds),
+    so its cost does not grow with the fleet size. Vehicles farther than
+    MAX_SNAP_METERS from the network, or on a road component not connected
+    to the target, can never be reached and are reported apart. Returns the
+    snapped target node, (vehicle index, road seconds, snap meters, ETA
+    seconds) tuples, fastest ETA first, and the unreachable vehicle indexes.
+    Raises ValueError if the target itself is off the network.
+    """
+    if G is None and not initialize_graph():
+        raise RuntimeError("Failed to initialize graph")
+    
+    target_node = nearest_node(G, target)
+    target_meters = haversine(target[0], target[1], target_node[0], target_node[1])
+    if target_meters > MAX_SNAP_METERS:
+        raise ValueError(f"Target is {target_meters:.0f} m from the road network (max {MAX_SNAP_METERS} m)")
+    snap_speed_mps = DEFAULT_SPEED_KMH / 3.6
+    target_component = node_component.get(target_node)
+    
+    vehicles_at_node: Dict[Tuple[float, float], List[int]] = {}
+    snap_meters = []
+    unreachable = []
+    for i, ((lon, lat), node) in enumerate(zip(vehicles, nearest_nodes(vehicles))):
+        snap_meters.append(haversine(lon, lat, node[0], node[1]))
+        if snap_meters[i] > MAX_SNAP_METERS or node_component.get(node) != target_component:
+            unreachable.append(i)
+        else:
+            vehicles_at_node.setdefault(node, []).append(i)
+    
+    found = []
+    best_etas = []  # Max-heap (negated) of the k best ETAs found so far
+    limit = math.inf if max_seconds is None else max_seconds
+    settled = set()
+    best = {target_node: 0.0}
+    heap = [(0.0, target_node)]
+    while heap:
+        t, u = heapq.heappop(heap)
+        # No unsettled vehicle can beat the current k-th best ETA or the limit
+        cutoff = min(limit, -best_etas[0]) if len(best_etas) == k else limit
+        if t > cutoff:
+            break
+        if u in settled:
+            continue
+        settled.add(u)
+        for i in vehicles_at_node.get(u, ()):
+            eta = t + snap_meters[i] / snap_speed_mps
+            if eta > limit:
+                continue
+            found.append((i, t, snap_meters[i], eta))
+            heapq.heappush(best_etas, -eta)
+            if len(best_etas) > k:
+                heapq.heappop(best_etas)
+        for v, data in G[u].items():
+            t_v = t + data["travel_time"]
+            if t_v <= limit and t_v < best.get(v, math.inf):
+                best[v] = t_v
+                heapq.heappush(heap, (t_v, v))
+    
+    found.sort(key=lambda item: item[3])
+    return target_node, found[:k], unreachable
+
 @router.post("/calculate", response_model=PathResponse)
 async def calculate_truck_path(request: PathRequest):
     """Calculate the optimal truck path using A* algorithm with ETA calculation"""
@@ -280,6 +469,78 @@ async def calculate_eta(request: PathRequest):
         print(f"Error calculating ETA: {e}")
         raise HTTPException(status_code=500, detail=f"Error calculating ETA: {str(e)}")
 
+# Plain def: FastAPI runs it in a worker thread, so the search and the
+# polygon do not block the event loop
+@router.post("/isochrone", response_model=IsochroneResponse)
+def calculate_isochrone(request: IsochroneRequest):
+    """Area and registered locations reachable from an origin within max_minutes"""
+    global G, gdf
+    
+    print(f"Calculating {request.max_minutes} min isochrone from {request.origin}")
+    
+    try:
+        if G is None:
+            print("Graph is None, initializing...")
+            if not initialize_graph():
+                print("Failed to initialize graph")
+                raise HTTPException(status_code=500, detail="Failed to initialize graph")
+            print("Graph initialized successfully")
+        
+        origin_node = nearest_node(G, request.origin)
+        origin_meters = haversine(*request.origin, *origin_node)
+        if origin_meters > MAX_SNAP_METERS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Origin is {origin_meters:.0f} m from the road network (max {MAX_SNAP_METERS} m)"
+            )
+        
+        # Legs between a point and its snapped node are driven at DEFAULT_SPEED_KMH,
+        # like the dispatch ETA; the origin leg is taken from the time budget
+        snap_speed_mps = DEFAULT_SPEED_KMH / 3.6
+        max_seconds = request.max_minutes * 60
+        origin_seconds = origin_meters / snap_speed_mps
+        road_seconds = max(max_seconds - origin_seconds, 0.0)
+        
+        # One Dijkstra over travel times, stopped at the time budget, so the cost
+        # depends on the explored area and not on how many locations are checked
+        travel_times = nx.single_source_dijkstra_path_length(
+            G, origin_node, cutoff=road_seconds, weight="travel_time"
+        )
+        
+        print(f"  Reachable nodes: {len(travel_times)}")
+        
+        locations = []
+        for stop in request.locations:
+            node = snap_location(stop.coordinates)
+            snap_meters = haversine(*stop.coordinates, *node)
+            if snap_meters > MAX_SNAP_METERS or node not in travel_times:
+                continue
+            seconds = origin_seconds + travel_times[node] + snap_meters / snap_speed_mps
+            if seconds <= max_seconds:
+                locations.append(ReachableLocation(
+                    name=stop.name,
+                    coordinates=stop.coordinates,
+                    time_minutes=seconds / 60
+                ))
+        locations.sort(key=lambda loc: loc.time_minutes)
+        
+        print(f"✅ {len(locations)}/{len(request.locations)} locations reachable")
+        
+        return IsochroneResponse(
+            origin_node=origin_node,
+            max_minutes=request.max_minutes,
+            reachable_nodes=len(travel_times),
+            polygon=reachable_polygon(travel_times, road_seconds),
+            locations=locations,
+            message=f"✅ {len(locations)} of {len(request.locations)} locations reachable within {request.max_minutes:.0f} minutes"
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error calculating isochrone: {e}")
+        raise HTTPException(status_code=500, detail=f"Error calculating isochrone: {str(e)}")
+
 @router.get("/status")
 async def get_status():
     """Get the status of the pathfinding service"""